@@ -1,13 +1,70 @@
 import math
-from scipy.cluster.vq import kmeans2
 
 import torch
-from torch import nn, einsum
+from torch import nn
 import torch.nn.functional as F
+import torch.distributed as dist
 
 import pytorch_lightning as pl
 
 
+def _code_counts(ind, k):
+    """
+    Number of occurrences of each of the k codes in ind. Same as torch.bincount(ind, minlength=k),
+    except that on cuda bincount reads ind.max() back to the host to size its output, which
+    syncs the stream; with k known up front we can just scatter into a (k,) tensor instead
+    """
+    return torch.zeros(k, device=ind.device).index_add_(0, ind, torch.ones(ind.size(0), device=ind.device))
+
+
+@torch.no_grad()
+def _kmeans_torch(x, k, iters=10):
+    """
+    Lloyd's k-means on x's device, a drop-in for scipy's kmeans2(x, k, minit='points')
+    that avoids the round trip through cpu/numpy. Returns the (k, C) centroids.
+    """
+    x = x.float()
+    centroids = x[torch.randperm(x.size(0), device=x.device)[:k]]
+    for _ in range(iters):
+        assign = torch.cdist(x, centroids).argmin(1)
+        counts = _code_counts(assign, k)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        # clusters that lost all their points keep their previous centroid
+        centroids = torch.where(counts.unsqueeze(1) > 0, sums / counts.clamp(min=1).unsqueeze(1), centroids)
+    return centroids
+
+
+@torch.no_grad()
+def _nearest_code(x, embed_t, embed_sqnorm, block_size=16384):
+    """
+    Index of the nearest (in L2) codebook vector for every row of x (N, C), given the codebook
+    transposed to (C, K) and its (K,) squared norms. Only the argmin is needed, so rows are
+    streamed through in blocks and at most a (block_size, K) score tile is ever alive, instead
+    of the full (N, K) distance matrix (and its autograd bookkeeping).
+    """
+    # argmin of ||x - e||^2 = ||x||^2 - 2x.e + ||e||^2 over e; the ||x||^2 term is constant per row so drop it
+    ind = torch.empty(x.size(0), dtype=torch.long, device=x.device)
+    for i in range(0, x.size(0), block_size):
+        scores = x[i:i+block_size] @ embed_t # (block_size, K)
+        scores.mul_(2).sub_(embed_sqnorm)
+        torch.argmax(scores, 1, out=ind[i:i+block_size])
+    return ind
+
+
+class _StraightThrough(torch.autograd.Function):
+    """
+    Returns z_q in the forward pass and passes the gradient through to z_e unchanged in the
+    backward pass, i.e. z_e + (z_q - z_e).detach() without materializing the two temporaries
+    """
+    @staticmethod
+    def forward(ctx, z_e, z_q):
+        return z_q
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
 class VQVAEQuantize(nn.Module):
     """
     Neural Discrete Representation Learning, van den Oord et al. 2017
@@ -16,6 +73,9 @@ class VQVAEQuantize(nn.Module):
     Follows the original DeepMind implementation
     https://github.com/deepmind/sonnet/blob/v2/sonnet/src/nets/vqvae.py
     https://github.com/deepmind/sonnet/blob/v2/examples/vqvae_example.ipynb
+
+    The codebook is updated with exponential moving averages of the encodings assigned to
+    each code (VQVAEEMA in sonnet) instead of by gradient descent on a codebook loss.
     """
     def __init__(self, num_hiddens, embedding_dim, n_embed):
         super().__init__()
@@ -23,46 +83,118 @@ class VQVAEQuantize(nn.Module):
         self.embedding_dim = embedding_dim
         self.n_embed = n_embed
 
-        self.proj = nn.Conv2d(num_hiddens, embedding_dim, 1)
+        # a 1x1 conv projection, kept as a plain (in, out) matrix so it can run as a single addmm on
+        # the (B*H*W, num_hiddens) flattened activations. initialized the same as nn.Conv2d(num_hiddens, embedding_dim, 1)
+        bound = 1 / math.sqrt(num_hiddens)
+        self.proj_weight = nn.Parameter(torch.empty(num_hiddens, embedding_dim).uniform_(-bound, bound))
+        self.proj_bias = nn.Parameter(torch.empty(embedding_dim).uniform_(-bound, bound))
         self.embed = nn.Embedding(n_embed, embedding_dim)
+        self.embed.weight.requires_grad_(False) # updated by the EMA below, not by the optimizer
+
+        # moving averages of the number of encodings assigned to each code and of their sum
+        self.register_buffer('cluster_size', torch.zeros(n_embed))
+        self.register_buffer('ema_embed', self.embed.weight.data.clone())
 
+        # the buffer persists the init state in checkpoints, the python flag mirrors it so that
+        # the hot path in forward never has to read it back from the device with .item()
         self.register_buffer('data_initialized', torch.zeros(1))
+        self._data_initialized = False
+
+        # the codebook transposed to a contiguous (C, K) for the nearest code GEMM, and its squared norms.
+        # allocated once and refreshed in place on k-means init and EMA updates, and rebuilt lazily after
+        # loads and train()/eval() switches. any other write to embed.weight must call _refresh_codebook()
+        self.register_buffer('_embed_t', torch.empty(embedding_dim, n_embed), persistent=False)
+        self.register_buffer('_embed_sqnorm', torch.empty(n_embed), persistent=False)
+        self._codebook_stale = True
 
     def forward(self, z):
         B, C, H, W = z.size()
 
-        # project and flatten out space, so (B, C, H, W) -> (B*H*W, C)
-        z_e = self.proj(z)
-        z_e = z_e.permute(0, 2, 3, 1) # make (B, H, W, C)
-        flatten = z_e.reshape(-1, self.embedding_dim)
+        # flatten out space and project, so (B, C, H, W) -> (B*H*W, C). the flattening is a free view for channels_last z
+        flatten = torch.addmm(self.proj_bias, z.permute(0, 2, 3, 1).reshape(-1, C), self.proj_weight)
+        z_e = flatten.view(B, H, W, self.embedding_dim)
 
         # DeepMind def does not do this but I find I have to... ;\
-        if self.training and self.data_initialized.item() == 0:
+        if self.training and not self._data_initialized:
             print('running kmeans!!') # data driven initialization for the embeddings
-            rp = torch.randperm(flatten.size(0))
-            kd = kmeans2(flatten[rp[:20000]].data.cpu().numpy(), self.n_embed, minit='points')
-            self.embed.weight.data.copy_(torch.from_numpy(kd[0]))
+            rp = torch.randperm(flatten.size(0), device=flatten.device)
+            self.embed.weight.data.copy_(_kmeans_torch(flatten[rp[:20000]].data, self.n_embed))
+            if dist.is_available() and dist.is_initialized():
+                dist.broadcast(self.embed.weight.data, src=0) # all ranks start from rank 0's codebook
+            # start the moving averages as if every code had been used uniformly so far
+            self.cluster_size.fill_(flatten.size(0) / self.n_embed)
+            self.ema_embed.copy_(self.embed.weight.data * self.cluster_size.unsqueeze(1))
             self.data_initialized.fill_(1)
-            # TODO: this won't work in multi-GPU setups
-
-        dist = (
-            flatten.pow(2).sum(1, keepdim=True)
-            - 2 * flatten @ self.embed.weight.t()
-            + self.embed.weight.pow(2).sum(1, keepdim=True).t()
-        )
-        _, ind = (-dist).max(1)
+            self._data_initialized = True
+            self._refresh_codebook()
+
+        # assign codes in fp32 even under autocast: bf16 rounding of the scores is coarser than the
+        # gap between nearby codes, which would flip assignments (and feed the noise into the EMA)
+        with torch.autocast(device_type=flatten.device.type, enabled=False):
+            flatten_fp32 = flatten.float()
+            if self._codebook_stale:
+                self._refresh_codebook()
+            ind = _nearest_code(flatten_fp32, self._embed_t, self._embed_sqnorm)
         ind = ind.view(B, H, W)
 
-        # vector quantization cost that trains the embedding vectors
+        # only the commitment cost remains, the embedding vectors are trained by the EMA update
         z_q = self.embed_code(ind) # (B, H, W, C)
         commitment_cost = 0.25
-        diff = commitment_cost * (z_q.detach() - z_e).pow(2).mean() + (z_q - z_e.detach()).pow(2).mean()
+        diff = commitment_cost * (z_q - z_e).pow(2).mean()
 
-        z_q = z_e + (z_q - z_e).detach() # noop in forward pass, straight-through gradient estimator in backward pass
+        if self.training:
+            self._update_codebook(flatten_fp32, ind.view(-1))
+
+        z_q = _StraightThrough.apply(z_e, z_q) # noop in forward pass, straight-through gradient estimator in backward pass
         z_q = z_q.permute(0, 3, 1, 2) # stack encodings into channels again: (B, C, H, W)
         return z_q, diff, ind
 
+    @torch.no_grad()
+    def _update_codebook(self, flatten, ind):
+        decay = 0.99
+        eps = 1e-5
+
+        counts = _code_counts(ind, self.n_embed)
+        embed_sum = torch.zeros_like(self.ema_embed).index_add_(0, ind, flatten)
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(counts)
+            dist.all_reduce(embed_sum)
+
+        self.cluster_size.mul_(decay).add_(counts, alpha=1 - decay)
+        self.ema_embed.mul_(decay).add_(embed_sum, alpha=1 - decay)
+
+        # laplace smoothing of the cluster sizes so that unused codes don't divide by zero
+        n = self.cluster_size.sum()
+        cluster_size = (self.cluster_size + eps) / (n + self.n_embed * eps) * n
+        self.embed.weight.copy_(self.ema_embed / cluster_size.unsqueeze(1))
+        self._refresh_codebook()
+
+    @torch.no_grad()
+    def _refresh_codebook(self):
+        self._embed_t.copy_(self.embed.weight.t())
+        torch.sum(self.embed.weight.pow(2), 1, out=self._embed_sqnorm)
+        self._codebook_stale = False
+
+    def train(self, mode=True):
+        self._codebook_stale = True # rebuild the codebook cache on every mode switch
+        return super().train(mode)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'cluster_size' not in state_dict and prefix + 'embed.weight' in state_dict:
+            # checkpoint from before the EMA codebook, seed the moving averages from its codebook
+            state_dict[prefix + 'cluster_size'] = torch.ones(self.n_embed)
+            state_dict[prefix + 'ema_embed'] = state_dict[prefix + 'embed.weight'].clone()
+        if prefix + 'proj.weight' in state_dict:
+            # checkpoint from when the projection was an nn.Conv2d, (out, in, 1, 1) -> (in, out)
+            state_dict[prefix + 'proj_weight'] = state_dict.pop(prefix + 'proj.weight').flatten(1).t()
+            state_dict[prefix + 'proj_bias'] = state_dict.pop(prefix + 'proj.bias')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._data_initialized = bool(self.data_initialized.item())
+        # the embed child module loads its weight after us, so only invalidate here
+        self._codebook_stale = True
+
     def embed_code(self, embed_id):
+        # note: code assignment reads a cached copy of embed.weight, call _refresh_codebook() after writing to it
         return F.embedding(embed_id, self.embed.weight)
 
 
@@ -86,17 +218,25 @@ class GumbelQuantize(nn.Module):
 
     def forward(self, z):
 
-        # force hard = True when we are in eval mode, as we must quantize
-        hard = self.straight_through if self.training else True
-
         logits = self.proj(z)
-        soft_one_hot = F.gumbel_softmax(logits, tau=self.temperature, dim=1, hard=hard)
-        z_q = einsum('b n h w, n d -> b d h w', soft_one_hot, self.embed.weight)
+
+        # in eval mode we must quantize, so skip the gumbel noise and the (B, N, H, W) softmax
+        # altogether and just look up the most likely code
+        if not self.training:
+            ind = logits.argmax(dim=1)
+            z_q = F.embedding(ind, self.embed.weight).permute(0, 3, 1, 2)
+            return z_q, logits.new_zeros(()), ind
+
+        soft_one_hot = F.gumbel_softmax(logits, tau=self.temperature, dim=1, hard=self.straight_through)
+        # (B, N, H, W) x (N, D) -> (B, D, H, W), done as a single plain GEMM over (B*H*W, N)
+        B, N, H, W = soft_one_hot.size()
+        z_q = soft_one_hot.permute(0, 2, 3, 1).reshape(-1, N) @ self.embed.weight
+        z_q = z_q.view(B, H, W, -1).permute(0, 3, 1, 2)
 
         # + kl divergence to the prior loss
         kld_scale = 5e-4 # lol. partly because we are lazily using unnormalized mse loss for reconstruction term
         qy = F.softmax(logits, dim=1)
-        diff = kld_scale * torch.sum(qy * torch.log(qy * self.n_embed + 1e-10), dim=1).mean()
+        diff = kld_scale * torch.special.xlogy(qy, qy * self.n_embed + 1e-10).sum(dim=1).mean()
 
         ind = soft_one_hot.argmax(dim=1)
         return z_q, diff, ind
@@ -114,9 +254,10 @@ class ResBlock(nn.Module):
 
     def forward(self, x):
         out = self.conv(x)
+        # both in place in eager mode (out is fresh from the 1x1 conv and not saved for backward),
+        # while still tracing to the add + relu pattern that FX int8 quantization fuses
         out += x
-        out = F.relu(out)
-        return out
+        return F.relu(out, inplace=True)
 
 
 class VQVAE(pl.LightningModule):
@@ -149,6 +290,7 @@ class VQVAE(pl.LightningModule):
             'gumbel': GumbelQuantize,
         }[args.vq_flavor]
         self.quantizer = QuantizerModule(num_hiddens, embedding_dim, num_embeddings)
+        self.val_counts = None # code usage histogram, accumulated on device over a validation epoch
 
         self.decoder = nn.Sequential(
             nn.Conv2d(embedding_dim, num_hiddens, 3, padding=1),
@@ -160,30 +302,75 @@ class VQVAE(pl.LightningModule):
             nn.ConvTranspose2d(num_hiddens//2, in_channel, 4, stride=2, padding=1),
         )
 
+        # NHWC is the faster layout for cudnn convs on tensor cores, and it also makes the
+        # (B, C, H, W) -> (B*H*W, C) flattening in the quantizers a free view rather than a copy
+        self.to(memory_format=torch.channels_last)
+
+        # opt-in bf16 mixed precision, only used on gpus that support it natively (ampere and up)
+        self.bf16 = getattr(args, 'bf16', False)
+
+        if getattr(args, 'compile', False):
+            # Module.compile compiles in place, so parameter names and checkpoints are unaffected. the
+            # quantizer takes a graph break on its one-time k-means init and recompiles once after it
+            self.encoder.compile(mode='reduce-overhead')
+            self.decoder.compile(mode='reduce-overhead')
+            self.quantizer.compile()
+
     def forward(self, x):
         z = self.encoder(x)
         z_q, diff, ind = self.quantizer(z)
         x_hat = self.decoder(z_q)
         return x_hat, diff, ind
 
+    @torch.no_grad()
+    def quantize_int8(self, calib_loader, num_batches=100):
+        """
+        Post-training static int8 quantization of the encoder/decoder convs, for cpu inference.
+        The activation observers are calibrated on the first num_batches batches of calib_loader.
+        The quantizer is left alone in fp32, its codebook is already a discrete representation.
+        """
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        self.cpu().eval()
+        qconfig_mapping = get_default_qconfig_mapping('x86')
+        x = next(iter(calib_loader))[0].contiguous(memory_format=torch.channels_last)
+        z_q = self.quantizer(self.encoder(x))[0]
+        self.encoder = prepare_fx(self.encoder, qconfig_mapping, (x,))
+        self.decoder = prepare_fx(self.decoder, qconfig_mapping, (z_q,))
+
+        for i, (x, y) in enumerate(calib_loader):
+            if i == num_batches:
+                break
+            self.forward(x.contiguous(memory_format=torch.channels_last))
+
+        self.encoder = convert_fx(self.encoder)
+        self.decoder = convert_fx(self.decoder)
+        return self
+
+    def use_bf16(self, x):
+        return self.bf16 and x.is_cuda and torch.cuda.is_bf16_supported()
+
     def training_step(self, batch, batch_idx):
         x, y = batch # hate that i have to do this here in the model
-        x_hat, latent_loss, ind = self.forward(x)
-        recon_loss = F.mse_loss(x_hat, x, reduction='mean')
-        loss = recon_loss + latent_loss
+        x = x.contiguous(memory_format=torch.channels_last)
+        # the codebook itself stays in fp32 and autocast keeps the losses in fp32
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_bf16(x)):
+            x_hat, latent_loss, ind = self.forward(x)
+            recon_loss = F.mse_loss(x_hat, x, reduction='mean')
+            loss = recon_loss + latent_loss
         return loss
 
     def validation_step(self, batch, batch_idx):
         x, y = batch # hate that i have to do this here in the model
-        x_hat, latent_loss, ind = self.forward(x)
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_bf16(x)):
+            x_hat, latent_loss, ind = self.forward(x)
+        x_hat = x_hat.float()
 
-        # eval cluster perplexity. when perplexity == num_embeddings then all clusters are used exactly equally
-        encodings = F.one_hot(ind, self.quantizer.n_embed).float().reshape(-1, self.quantizer.n_embed)
-        avg_probs = encodings.mean(0)
-        perplexity = (-(avg_probs * torch.log(avg_probs + 1e-10)).sum()).exp()
-        cluster_use = torch.sum(avg_probs > 0)
-        self.log('val_perplexity', perplexity, prog_bar=True)
-        self.log('val_cluster_use', cluster_use, prog_bar=True)
+        # accumulate code usage over the epoch, perplexity is evaluated once at the end of it
+        counts = _code_counts(ind.reshape(-1), self.quantizer.n_embed)
+        self.val_counts = counts if self.val_counts is None else self.val_counts + counts
 
         """
         data variance is fixed, estimated and used by deepmind in their cifar10 example presumably
@@ -195,39 +382,39 @@ class VQVAE(pl.LightningModule):
         recon_error = F.mse_loss(x_hat, x, reduction='mean') / data_variance
         self.log('val_recon_error', recon_error, prog_bar=True) # DeepMind converges to 0.056 in 4min 29s wallclock
 
+    def on_validation_epoch_end(self):
+        if self.val_counts is None:
+            return
+        counts, self.val_counts = self.val_counts, None
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(counts)
+
+        # eval cluster perplexity. when perplexity == num_embeddings then all clusters are used exactly equally
+        avg_probs = counts / counts.sum()
+        perplexity = torch.special.entr(avg_probs).sum().exp() # entr(p) = -p log p, and 0 at p = 0
+        cluster_use = torch.sum(counts > 0)
+        self.log('val_perplexity', perplexity, prog_bar=True)
+        self.log('val_cluster_use', cluster_use, prog_bar=True)
+
     def configure_optimizers(self):
 
-        # separate out all parameters to those that will and won't experience regularizing weight decay
-        decay = set()
-        no_decay = set()
-        whitelist_weight_modules = (torch.nn.Linear, torch.nn.Conv2d, torch.nn.ConvTranspose2d)
+        # separate out all parameters to those that will and won't experience regularizing weight decay:
+        # biases and the weights of blacklist modules are not decayed, everything else (conv weights) is
         blacklist_weight_modules = (torch.nn.LayerNorm, torch.nn.BatchNorm2d, torch.nn.Embedding)
-        for mn, m in self.named_modules():
-            for pn, p in m.named_parameters():
-                fpn = '%s.%s' % (mn, pn) if mn else pn # full param name
-
-                if pn.endswith('bias'):
-                    # all biases will not be decayed
-                    no_decay.add(fpn)
-                elif pn.endswith('weight') and isinstance(m, whitelist_weight_modules):
-                    # weights of whitelist modules will be weight decayed
-                    decay.add(fpn)
-                elif pn.endswith('weight') and isinstance(m, blacklist_weight_modules):
-                    # weights of blacklist modules will NOT be weight decayed
-                    no_decay.add(fpn)
-
-        # validate that we considered every parameter
-        param_dict = {pn: p for pn, p in self.named_parameters()}
-        inter_params = decay & no_decay
-        union_params = decay | no_decay
-        assert len(inter_params) == 0, "parameters %s made it into both decay/no_decay sets!" % (str(inter_params), )
-        assert len(param_dict.keys() - union_params) == 0, "parameters %s were not separated into either decay/no_decay set!" \
-                                                    % (str(param_dict.keys() - union_params), )
+        module_of_param = {id(p): m for m in self.modules() for p in m.parameters(recurse=False)}
+        decay, no_decay = [], []
+        for pn, p in self.named_parameters():
+            if not p.requires_grad:
+                continue # e.g. the EMA-updated VQ codebook
+            if pn.endswith('bias') or isinstance(module_of_param[id(p)], blacklist_weight_modules):
+                no_decay.append(p)
+            else:
+                decay.append(p)
 
         # create the pytorch optimizer object
         optim_groups = [
-            {"params": [param_dict[pn] for pn in sorted(list(decay))], "weight_decay": 1e-5},
-            {"params": [param_dict[pn] for pn in sorted(list(no_decay))], "weight_decay": 0.0},
+            {"params": decay, "weight_decay": 1e-5},
+            {"params": no_decay, "weight_decay": 0.0},
         ]
         optimizer = torch.optim.AdamW(optim_groups, lr=3e-4, weight_decay=1e-5)
 
@@ -14,6 +14,8 @@ def main():
     parser = ArgumentParser()
     # model related
     parser.add_argument("--vq_flavor", type=str, default='vqvae', choices=['vqvae', 'gumbel'])
+    parser.add_argument("--bf16", action='store_true', help="bf16 mixed precision autocast, on gpus that support it")
+    parser.add_argument("--compile", action='store_true', help="torch.compile the encoder, quantizer and decoder")
     # data related
     parser.add_argument("--data_dir", type=str, default='/apcv/users/akarpathy/cifar10')
     parser.add_argument("--batch_size", type=int, default=128)